@@ -0,0 +1,291 @@
+"""Framework-independent core of the real-estate ledger.
+
+Record storage (Parquet shards and the NDJSON event log, including its replay) and the
+columnar conversion of remote documents live here, free of Streamlit, so
+`real_estate_ledger.py` only deals with UI and session state. Statistics and CSV export
+run in pandas in the app. Everything is type-annotated so the per-record loops here (log
+replay, event encoding, column conversion) can be compiled ahead of time with mypyc
+(`mypyc --ignore-missing-imports ledger_core.py`); without a compiled extension the plain
+module is imported.
+"""
+import hashlib
+import os
+import re
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Iterator, Optional
+
+import pandas as pd
+
+# Optional: orjson for faster JSON encoding/decoding
+_HAS_ORJSON = False
+try:
+    import orjson
+    _HAS_ORJSON = True
+except Exception:
+    # orjson not installed; try ujson, then the stdlib json module
+    _HAS_ORJSON = False
+
+# Optional: ujson as the fallback when orjson is missing
+_HAS_UJSON = False
+if not _HAS_ORJSON:
+    try:
+        import ujson
+        _HAS_UJSON = True
+    except Exception:
+        _HAS_UJSON = False
+
+if not (_HAS_ORJSON or _HAS_UJSON):
+    import json
+
+# Optional: fcntl for advisory file locks (POSIX only)
+_HAS_FCNTL = False
+try:
+    import fcntl
+    _HAS_FCNTL = True
+except Exception:
+    # not available on Windows; writes are then only atomic, not serialized
+    _HAS_FCNTL = False
+
+# 费用记录字段
+EXPENSE_FIELDS: list[str] = ["日期", "费用类型", "金额", "描述"]
+
+# 事件日志中记录字段的短键：每条 add 事件都带一条完整记录，短 ASCII 键让日志更小、解析更快
+SHORT_KEYS: dict[str, str] = {"日期": "d", "费用类型": "t", "金额": "a", "描述": "n"}
+LONG_KEYS: dict[str, str] = {short: field for field, short in SHORT_KEYS.items()}
+
+# 预设费用类型；费用类型下拉框的选项为预设类型加“其他”。定义在这里而不是应用脚本中，
+# 因为应用脚本每次重跑都会重新执行，而本模块每个进程只导入一次
+PRESET_EXPENSE_TYPES: list[str] = ["契税", "土地出让金", "中介费", "装修费"]
+EXPENSE_TYPE_CHOICES: tuple[str, ...] = (*PRESET_EXPENSE_TYPES, "其他")
+
+# 快照分片文件名：属性名 sha1 的前 16 位 + 快照时的 seq；清理旧分片时只删除符合此格式的文件
+SHARD_NAME_RE = re.compile(r"[0-9a-f]{16}\.\d+\.parquet")
+
+# last_seq() only reads this many bytes from the end of the log; events are far smaller
+LOG_TAIL_BYTES = 65536
+
+
+# --- JSON codec ---
+def dumps(obj: Any) -> bytes:
+    """Compact UTF-8 JSON; these files are machine-read, so no indentation or spaces."""
+    if _HAS_ORJSON:
+        return orjson.dumps(obj)
+    if _HAS_UJSON:
+        return ujson.dumps(obj, ensure_ascii=False).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: bytes) -> Any:
+    if _HAS_ORJSON:
+        return orjson.loads(data)
+    if _HAS_UJSON:
+        return ujson.loads(data)
+    return json.loads(data)
+
+
+# --- Atomic writes ---
+def write_atomic(path: str, data: bytes) -> None:
+    """Replace `path` with `data` so readers see either the old or the new file, never a torn one."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+@contextmanager
+def locked(lock_path: str) -> Iterator[None]:
+    """Hold an exclusive advisory lock on `lock_path` so concurrent workers don't interleave writes.
+
+    The lock is not reentrant: don't nest it for the same file.
+    """
+    with open(lock_path, "ab") as f:
+        if _HAS_FCNTL:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if _HAS_FCNTL:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+# --- User paths ---
+def valid_username(username: str) -> bool:
+    """True if `username` can be used as a single directory name under the data dir, i.e. it
+    can't point outside it (no path separators, no "..", not absolute)."""
+    if not username or username in (".", "..") or ".." in username or "\0" in username:
+        return False
+    if os.sep in username or (os.altsep and os.altsep in username):
+        return False
+    return not os.path.isabs(username)
+
+
+# Memoized here rather than in the app: the Streamlit script is re-executed on every rerun, so
+# a cache defined there would start empty each time. These run on every load/save.
+@lru_cache(maxsize=1024)
+def user_paths(data_dir: str, username: str) -> tuple[str, str, str]:
+    """Return (user_dir, index_path, log_path) for a user; ValueError if the name is unsafe."""
+    if not valid_username(username):
+        raise ValueError(f"invalid username: {username!r}")
+    user_dir = os.path.join(data_dir, username)
+    return user_dir, os.path.join(user_dir, "index.json"), os.path.join(user_dir, "events.ndjson")
+
+
+@lru_cache(maxsize=1024)
+def lock_path(data_dir: str, username: str) -> str:
+    return os.path.join(user_paths(data_dir, username)[0], ".lock")
+
+
+@lru_cache(maxsize=1024)
+def legacy_paths(data_dir: str, username: str) -> tuple[str, str]:
+    """Return (snapshot_path, log_path) of the single-file layout used before per-user directories."""
+    if not valid_username(username):
+        raise ValueError(f"invalid username: {username!r}")
+    return os.path.join(data_dir, f"{username}.json"), os.path.join(data_dir, f"{username}.ndjson")
+
+
+# --- Property shards ---
+def shard_name(property_name: str, seq: int) -> str:
+    """Return the Parquet file name of a property's snapshot taken at event `seq`."""
+    digest = hashlib.sha1(property_name.encode("utf-8")).hexdigest()[:16]
+    return f"{digest}.{seq}.parquet"
+
+
+def is_shard_name(file_name: str) -> bool:
+    """True if `file_name` looks like a name returned by shard_name()."""
+    return SHARD_NAME_RE.fullmatch(file_name) is not None
+
+
+def write_records(path: str, records: list[dict[str, Any]]) -> None:
+    # astype() on the frame rather than assigning a column: the compiled module trips pandas'
+    # chained-assignment check on the column assignment
+    df = pd.DataFrame(records, columns=EXPENSE_FIELDS).astype({"金额": "float64"})
+    # through write_atomic() so the shard is fsynced before index.json can point at it
+    write_atomic(path, df.to_parquet(None, compression="zstd", index=False))
+
+
+def load_records(path: str) -> list[dict[str, Any]]:
+    records: list[dict[str, Any]] = pd.read_parquet(path).to_dict(orient="records")
+    return records
+
+
+# --- Columnar documents ---
+def to_columns(records: list[dict[str, Any]]) -> dict[str, list[Any]]:
+    """Return `records` as one list per EXPENSE_FIELDS column, so field names are stored once."""
+    return {field: [record[field] for record in records] for field in EXPENSE_FIELDS}
+
+
+def from_columns(columns: dict[str, list[Any]]) -> list[dict[str, Any]]:
+    """Inverse of to_columns()."""
+    return [dict(zip(EXPENSE_FIELDS, row)) for row in zip(*(columns[field] for field in EXPENSE_FIELDS))]
+
+
+# --- Event log ---
+def encode_event(seq: int, event: dict[str, Any]) -> bytes:
+    """Return the log line for `event` numbered `seq`, with its record stored under SHORT_KEYS."""
+    line = {"seq": seq, **event}
+    if "record" in event:
+        line["record"] = {SHORT_KEYS[field]: value for field, value in event["record"].items()}
+    return dumps(line) + b"\n"
+
+
+def apply_event(properties: dict[str, list[dict[str, Any]]], event: dict[str, Any]) -> None:
+    """Replay a single logged edit onto `properties` in place.
+
+    Records may use SHORT_KEYS (current logs) or the full field names (older logs). A delete
+    that no longer matches `properties` (missing property or index out of range) is skipped
+    rather than raised, so one bad event can't make the whole ledger unloadable.
+    """
+    op = event["op"]
+    name = event["property"]
+    if op == "add":
+        record = event["record"]
+        if "日期" not in record:
+            record = {LONG_KEYS[short]: value for short, value in record.items()}
+        properties.setdefault(name, []).append(record)
+    elif op == "delete":
+        records = properties.get(name)
+        index = event["index"]
+        if records is not None and 0 <= index < len(records):
+            records.pop(index)
+    elif op == "add_property":
+        properties.setdefault(name, [])
+    elif op == "delete_property":
+        properties.pop(name, None)
+
+
+def rebase_event(properties: dict[str, list[dict[str, Any]]], event: dict[str, Any]) -> Optional[dict[str, Any]]:
+    """Return `event` (made on an outdated copy of the ledger) adjusted to apply onto `properties`,
+    or None if it no longer applies.
+
+    Delete events carry the record they removed, so they are re-pointed at that record's current
+    position; deletes from a property that no longer exists, or of a record that is already gone,
+    are dropped. Adds always apply: apply_event() recreates a missing property, which is also how
+    a property that only existed in memory (e.g. 默认房产 before its first save) reaches disk.
+    """
+    op = event["op"]
+    name = event["property"]
+    if op == "add_property":
+        return None if name in properties else event
+    if op == "add":
+        return event
+    records = properties.get(name)
+    if records is None:
+        return None
+    if op != "delete":
+        return event
+    index = event["index"]
+    record = event.get("record")
+    if record is None:
+        return event if 0 <= index < len(records) else None
+    if 0 <= index < len(records) and records[index] == record:
+        return event
+    try:
+        return {**event, "index": records.index(record)}
+    except ValueError:
+        return None
+
+
+def replay_log(log_file: str, properties: dict[str, list[dict[str, Any]]], seq: int, touched: set[str]) -> int:
+    """Apply the events in `log_file` newer than `seq` onto `properties`; return the last seq.
+
+    The names of the properties the replayed events touch are added to `touched`.
+    """
+    if not os.path.exists(log_file):
+        return seq
+    with open(log_file, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                event = loads(line)
+            except ValueError:
+                # torn last line from an interrupted append
+                break
+            if event["seq"] <= seq:
+                continue
+            apply_event(properties, event)
+            touched.add(event["property"])
+            seq = event["seq"]
+    return seq
+
+
+def last_seq(log_file: str, seq: int) -> int:
+    """Return the seq of the newest complete event in `log_file`, or `seq` if it is newer or the
+    log is missing or empty. Only the tail of the file is read."""
+    try:
+        with open(log_file, "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(0, size - LOG_TAIL_BYTES))
+            tail = f.read()
+    except FileNotFoundError:
+        return seq
+    for line in reversed(tail.splitlines()):
+        try:
+            return max(seq, loads(line)["seq"])
+        except (ValueError, TypeError, KeyError):
+            # torn last line, or the cut-off first line of the tail
+            continue
+    return seq
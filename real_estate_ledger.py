@@ -1,10 +1,33 @@
 import streamlit as st
-import csv
+import hashlib
 import io
-import json
 import os
+import pandas as pd
 from datetime import datetime
-from collections import defaultdict
+
+from ledger_core import (
+    EXPENSE_FIELDS,
+    EXPENSE_TYPE_CHOICES,
+    apply_event,
+    dumps,
+    encode_event,
+    from_columns,
+    is_shard_name,
+    last_seq,
+    legacy_paths,
+    load_records,
+    loads,
+    lock_path,
+    locked,
+    rebase_event,
+    replay_log,
+    shard_name,
+    to_columns,
+    user_paths,
+    valid_username,
+    write_atomic,
+    write_records,
+)
 
 # Optional: supabase client for remote persistence
 _HAS_SUPABASE = False
@@ -22,13 +45,21 @@ st.set_page_config(
     layout="wide"
 )
 
-# 创建数据目录
+# 创建数据目录：每个进程只执行一次，而不是每次重跑都检查
 DATA_DIR = "user_data"
-if not os.path.exists(DATA_DIR):
-    os.makedirs(DATA_DIR)
+
+
+@st.cache_resource(show_spinner=False)
+def _bootstrap():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return True
+
+
+_bootstrap()
 
 
 # --- Remote persistence helpers (Supabase) ---
+@st.cache_data(ttl=3600, show_spinner=False)
 def _has_remote_config():
     # Streamlit secrets can store SUPABASE_URL and SUPABASE_KEY
     try:
@@ -37,23 +68,48 @@ def _has_remote_config():
         return False
 
 
+@st.cache_resource(show_spinner=False)
 def _get_supabase_client():
-    """Return a Supabase client using Streamlit secrets. Caller should check _has_remote_config() first."""
+    """Return a Supabase client using Streamlit secrets. Caller should check _has_remote_config() first.
+
+    Cached for the lifetime of the process so reruns and sessions share one client and its
+    pooled HTTP connections instead of re-creating them on every load/save.
+    """
     url = st.secrets.get("SUPABASE_URL")
     key = st.secrets.get("SUPABASE_KEY")
     return create_client(url, key)
 
 
+@st.cache_data(ttl=30, show_spinner=False)
+def _load_remote(username: str):
+    """Cached SELECT of a user's `ledgers` row; cleared whenever this process upserts.
+
+    The short ttl bounds how long writes from other replicas (or edits made in Supabase
+    directly) stay invisible, so a login doesn't load an old document and overwrite them.
+    """
+    client = _get_supabase_client()
+    resp = client.table("ledgers").select("data").eq("username", username).execute()
+    data_rows = resp.data if hasattr(resp, "data") else resp.get("data")
+    if data_rows:
+        return data_rows[0].get("data") if isinstance(data_rows[0], dict) else None
+    return None
+
+
 def load_user_data_remote(username: str):
     """Load user data from a Supabase table named `ledgers` with columns (username text primary key, data jsonb).
     Returns None if not found.
+
+    Properties are stored column-wise (see save_user_data_remote()); documents written
+    before that, with a list of record dicts per property, are read as they are.
     """
     try:
-        client = _get_supabase_client()
-        resp = client.table("ledgers").select("data").eq("username", username).execute()
-        data_rows = resp.data if hasattr(resp, "data") else resp.get("data")
-        if data_rows:
-            return data_rows[0].get("data") if isinstance(data_rows[0], dict) else None
+        data = _load_remote(username)
+        if isinstance(data, dict) and isinstance(data.get("properties"), dict):
+            data["properties"] = {
+                name: from_columns(records) if isinstance(records, dict) else records
+                for name, records in data["properties"].items()
+            }
+        return data
     except Exception as e:
         # don't crash the app for remote errors; fall back to local
         st.error(f"远程加载数据失败: {e}")
@@ -61,25 +117,136 @@ def load_user_data_remote(username: str):
 
 
 def save_user_data_remote(username: str, data: dict):
-    """Upsert user data into Supabase `ledgers` table."""
+    """Upsert user data into Supabase `ledgers` table.
+
+    Each property's records are sent as columns ({field: [values]}) rather than a list of
+    dicts, so the field names aren't repeated for every record. The request is skipped when
+    the document is byte-identical to the one this session last upserted.
+    """
     try:
-        client = _get_supabase_client()
-        # upsert with primary key = username
-        client.table("ledgers").upsert({"username": username, "data": data}).execute()
+        document = {
+            **data,
+            "properties": {name: to_columns(records) for name, records in data["properties"].items()}
+        }
+        digest = hashlib.blake2b(dumps(document), digest_size=16).digest()
+        if digest == st.session_state.get("last_saved_hash"):
+            return True
+        # upsert with primary key = username; the array form goes through PostgREST's bulk path
+        _get_supabase_client().table("ledgers").upsert(
+            [{"username": username, "data": document}], on_conflict="username"
+        ).execute()
+        _load_remote.clear()
+        st.session_state.last_saved_hash = digest
         return True
     except Exception as e:
         st.error(f"远程保存数据失败: {e}")
         return False
 
+
 # --- end remote helpers ---
 
+# --- Local persistence helpers (Parquet snapshot + append-only event log) ---
+# Each user has a directory `user_data/{username}/` holding
+#   index.json     {"username", "seq", "properties": {name: shard file}} (property order kept)
+#   <shard>.parquet one columnar snapshot per property
+#   events.ndjson  the edits made since the snapshot, one JSON object per line (records use
+#                  ledger_core.SHORT_KEYS)
+#   .lock          advisory lock serializing writers (several Streamlit workers, same user)
+# Every event carries a monotonically increasing `seq`; the index records the last `seq`
+# the snapshot contains, so events left behind by an interrupted compaction are skipped.
+# Shard file names include that `seq`, so a snapshot is committed by the single write of
+# index.json and a crash mid-compaction leaves the previous snapshot intact. index.json and
+# shards are written to a `.tmp` file and renamed into place, so they are never seen torn.
+# Legacy `user_data/{username}.json` (+ `.ndjson`) files are still read until the first
+# snapshot in the new layout is written.
+LOG_COMPACT_RATIO = 10
+
+
+def _user_paths(username: str):
+    """Return (user_dir, index_path, log_path) for a user."""
+    return user_paths(DATA_DIR, username)
+
+
+def _lock_path(username: str):
+    return lock_path(DATA_DIR, username)
+
+
+def _legacy_paths(username: str):
+    """Return (snapshot_path, log_path) of the single-file layout used before per-user directories."""
+    return legacy_paths(DATA_DIR, username)
+
+
+def _local_version(username: str):
+    """Return (name, mtime_ns, size) of every file backing the user's data; changes on any write."""
+    version = []
+    try:
+        with os.scandir(_user_paths(username)[0]) as entries:
+            for entry in entries:
+                stat_result = entry.stat()
+                version.append((entry.name, stat_result.st_mtime_ns, stat_result.st_size))
+    except FileNotFoundError:
+        pass
+    # one stat() per file instead of an exists() check followed by stat()
+    for path in _legacy_paths(username):
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            continue
+        version.append((path, stat_result.st_mtime_ns, stat_result.st_size))
+    return tuple(sorted(version))
+
+
+@st.cache_data(show_spinner=False)
+def _load_local(username: str, mtime):
+    """Rebuild a user's properties from the snapshot plus the event log.
+
+    `mtime` is the _local_version() of the user's files and only serves as cache key, so
+    repeated logins skip the disk read and replay until the files change.
+    Returns (properties, seq, touched) where seq is the last applied event number and touched
+    the properties changed since the snapshot.
+    """
+    if not os.path.isdir(_user_paths(username)[0]):
+        return _read_local(username)
+    # read under the lock so a concurrent compaction can't remove the shards or the log
+    # between reading index.json and reading them
+    with locked(_lock_path(username)):
+        return _read_local(username)
+
+
+def _read_local(username: str):
+    """Body of _load_local(), uncached; the caller holds the user's lock if the user directory exists."""
+    user_dir, index_file, log_file = _user_paths(username)
+    touched = set()
+    if os.path.exists(index_file):
+        with open(index_file, "rb") as f:
+            index = loads(f.read())
+        properties = {
+            name: load_records(os.path.join(user_dir, shard))
+            for name, shard in index["properties"].items()
+        }
+        return properties, replay_log(log_file, properties, index["seq"], touched), touched
+
+    legacy_file, legacy_log = _legacy_paths(username)
+    properties, seq = {}, 0
+    if os.path.exists(legacy_file):
+        with open(legacy_file, "rb") as f:
+            data = loads(f.read())
+        properties = data.get("properties", {})
+        seq = data.get("seq", 0)
+    seq = replay_log(legacy_log, properties, seq, touched)
+    return properties, replay_log(log_file, properties, seq, touched), touched
+
+# --- end local helpers ---
+
 # 加载用户数据
 def load_user_data():
     """Load user data for current session. If remote (Supabase) is configured, prefer remote data.
 
-    Falls back to local JSON file in `user_data/` if remote isn't available or lookup fails.
+    Falls back to the local snapshot + event log in `user_data/` if remote isn't available or lookup fails.
     """
     username = st.session_state.username
+    # the properties are replaced below, so views memoized by ledger_view() are outdated
+    st.session_state.revision += 1
     if not username:
         st.session_state.properties = {"默认房产": []}
         return
@@ -94,20 +261,44 @@ def load_user_data():
             return
 
     # Fallback to local file
-    user_file = os.path.join(DATA_DIR, f"{username}.json")
-    if os.path.exists(user_file):
-        with open(user_file, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            st.session_state.properties = data.get("properties", {})
-            # 确保有一个默认房产
-            if not st.session_state.properties:
-                st.session_state.properties = {"默认房产": []}
-    else:
+    st.session_state.local_version = _local_version(username)
+    (
+        st.session_state.properties,
+        st.session_state.log_seq,
+        st.session_state.dirty_properties
+    ) = _load_local(username, st.session_state.local_version)
+    # 确保有一个默认房产
+    if not st.session_state.properties:
         st.session_state.properties = {"默认房产": []}
 
 # 保存用户数据
+def mark_dirty(event=None):
+    """Record an edit of the current user's data; flush_user_data() persists it at the end of the rerun.
+
+    `event` is the edit as logged locally, e.g. {"op": "add", "property": ..., "record": ...};
+    None requests a full snapshot instead. Several edits in one rerun are saved together.
+    """
+    st.session_state.dirty = True
+    st.session_state.pending_events.append(event)
+    st.session_state.revision += 1
+
+
+def flush_user_data():
+    """Save the current user's data once if anything was marked dirty since the last flush."""
+    if st.session_state.get("dirty"):
+        save_user_data()
+        st.session_state.dirty = False
+
+
 def save_user_data():
-    """Save current user's data. If remote is configured, try remote upsert and fall back to local file on failure."""
+    """Save the edits queued by mark_dirty(). If remote is configured, upsert the whole document in
+    one request and fall back to a local snapshot on failure.
+
+    Locally, the queued events are appended to the user's event log in one write; if a full
+    snapshot was requested the snapshot is rewritten instead.
+    """
+    events = st.session_state.get("pending_events", [])
+    st.session_state.pending_events = []
     username = st.session_state.username
     if not username:
         return
@@ -119,18 +310,216 @@ def save_user_data():
 
     # If remote storage available, try that first
     if _has_remote_config():
-        ok = save_user_data_remote(username, data)
-        if ok:
-            return
+        if not save_user_data_remote(username, data):
+            _save_user_data_local(data)
+            _evict_local_cache(username)
+        return
+
+    if None in events:
+        _save_user_data_local(data)
+    elif events:
+        _append_events(data, events)
+    _evict_local_cache(username)
+
+
+def _evict_local_cache(username: str):
+    """Drop the cached _load_local() entry this session was loaded from; its files were just rewritten."""
+    version = st.session_state.pop("local_version", None)
+    if version is not None:
+        _load_local.clear(username, version)
+
+
+def _disk_seq(username: str):
+    """Return the newest seq stored on disk for a user (snapshot or log); the caller holds the lock."""
+    _, index_file, log_file = _user_paths(username)
+    seq = 0
+    try:
+        with open(index_file, "rb") as f:
+            seq = loads(f.read())["seq"]
+    except FileNotFoundError:
+        pass
+    return last_seq(log_file, seq)
+
 
-    # Fallback to local file storage
+def _rebase_onto_disk(data: dict, events: list):
+    """Reload the user's ledger from disk and replay this session's unsaved `events` onto it.
+
+    Returns the events that still apply, rewritten for the reloaded ledger (ledger_core.rebase_event);
+    the session's properties are replaced by the merged result. The caller holds the user's lock.
+    """
+    properties, seq, touched = _read_local(data["username"])
+    rebased = []
+    for event in events:
+        event = rebase_event(properties, event)
+        if event is not None:
+            apply_event(properties, event)
+            rebased.append(event)
+    st.session_state.properties = properties
+    st.session_state.log_seq = seq
+    st.session_state.dirty_properties = touched
+    data["properties"] = properties
+    st.session_state.revision += 1
+    reindex_properties()
+    return rebased
+
+
+def _append_events(data: dict, events: list):
+    """Append edits to the user's event log, compacting it into the snapshot once it
+    grows past LOG_COMPACT_RATIO times the snapshot size.
+
+    Sequence numbers are assigned under the user's lock from what is on disk. If another
+    session (e.g. a second tab) wrote since this one loaded, its edits are reloaded first and
+    this session's edits are rebased onto them (see _rebase_onto_disk()), so deletes hit the
+    intended records and a stale copy is never compacted over the other session's edits.
+    """
+    username = data["username"]
+    user_dir, index_file, log_file = _user_paths(username)
+    try:
+        os.makedirs(user_dir, exist_ok=True)
+        with locked(_lock_path(username)):
+            if _disk_seq(username) > st.session_state.get("log_seq", 0):
+                events = _rebase_onto_disk(data, events)
+            lines = []
+            for event in events:
+                st.session_state.log_seq += 1
+                lines.append(encode_event(st.session_state.log_seq, event))
+                st.session_state.dirty_properties.add(event["property"])
+            if lines:
+                with open(log_file, "ab") as f:
+                    f.write(b"".join(lines))
+                    # one fsync per flushed batch of edits, like write_atomic() does for snapshots
+                    f.flush()
+                    os.fsync(f.fileno())
+            if not os.path.exists(log_file):
+                return
+            log_size = os.path.getsize(log_file)
+            snapshot_size = 0
+            if os.path.exists(index_file):
+                with os.scandir(user_dir) as entries:
+                    snapshot_size = sum(entry.stat().st_size for entry in entries) - log_size
+            if log_size > LOG_COMPACT_RATIO * snapshot_size:
+                _write_snapshot(data, changed=st.session_state.dirty_properties)
+    except Exception as e:
+        st.error(f"本地保存数据失败: {e}")
+
+
+def _save_user_data_local(data: dict, changed=None):
+    """Write user data as a Parquet snapshot under `user_data/{username}/` and reset the event log.
+
+    With `changed` (the property names edited since the current snapshot), the shards of all
+    other properties are carried over from the existing index instead of being rewritten.
+    """
     try:
-        user_file = os.path.join(DATA_DIR, f"{username}.json")
-        with open(user_file, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.makedirs(_user_paths(data["username"])[0], exist_ok=True)
+        with locked(_lock_path(data["username"])):
+            _write_snapshot(data, changed)
     except Exception as e:
         st.error(f"本地保存数据失败: {e}")
 
+
+def _write_snapshot(data: dict, changed=None):
+    """Body of _save_user_data_local(); the caller holds the user's lock."""
+    user_dir, index_file, log_file = _user_paths(data["username"])
+    seq = st.session_state.get("log_seq", 0)
+    previous = {}
+    if changed is not None and os.path.exists(index_file):
+        with open(index_file, "rb") as f:
+            previous = loads(f.read())["properties"]
+    shards = {}
+    for name, records in data["properties"].items():
+        if name in previous and name not in changed:
+            shards[name] = previous[name]
+            continue
+        shards[name] = shard_name(name, seq)
+        write_records(os.path.join(user_dir, shards[name]), records)
+    # index.json is the commit point: it switches the snapshot to the new shards
+    write_atomic(index_file, dumps({"username": data["username"], "seq": seq, "properties": shards}))
+    try:
+        os.remove(log_file)
+    except FileNotFoundError:
+        pass
+    st.session_state.dirty_properties = set()
+    live = set(shards.values())
+    with os.scandir(user_dir) as entries:
+        for entry in entries:
+            # only our own stale shards; anything else in the directory is left alone
+            if is_shard_name(entry.name) and entry.name not in live:
+                os.remove(entry.path)
+
+# 导出CSV
+def export_csv(df) -> bytes:
+    """Return the CSV export of an expenses_frame() as bytes.
+
+    Rows end in CRLF and the UTF-8 output starts with a BOM so spreadsheet apps detect the
+    encoding. pandas' C writer encodes straight into a byte buffer, so no intermediate str
+    copy of the whole file is built.
+    """
+    buffer = io.BytesIO()
+    df.to_csv(buffer, index=False, lineterminator="\r\n", encoding="utf-8-sig")
+    return buffer.getvalue()
+
+# 费用记录的列式视图
+def expenses_frame(expenses):
+    """Return `expenses` (a list of record dicts) as a DataFrame with one typed column per field.
+
+    Built once per change of the records and shared by the detail table and the CSV export.
+    """
+    df = pd.DataFrame(expenses, columns=EXPENSE_FIELDS)
+    df["金额"] = df["金额"].astype("float64")
+    return df
+
+
+# 统计费用
+SUMMARY_TOP_K = 20
+
+
+def summarize_expenses(df):
+    """Return (total, top types, hidden_count) for an expenses_frame().
+
+    Per-type totals come from one vectorized groupby on the typed 金额 column; only the
+    SUMMARY_TOP_K largest types are selected (in descending order) since that is all the
+    panel lists, and hidden_count is how many types were left out.
+    """
+    type_totals = df.groupby("费用类型", sort=False)["金额"].sum()
+    type_summary = type_totals.nlargest(SUMMARY_TOP_K)
+    return float(type_totals.sum()), type_summary.to_dict(), len(type_totals) - len(type_summary)
+
+# 费用明细表
+def expense_table(df):
+    """Return the detail-table view of an expenses_frame().
+
+    Empty descriptions are replaced by "-" once per change of the records. Amounts stay
+    numeric (formatted by the table's column config) so the column sorts by value.
+    """
+    df = df.copy()
+    df["描述"] = df["描述"].where(df["描述"].astype(bool), "-")
+    return df
+
+
+# 当前房产的视图：记录不变时跨重跑复用
+def ledger_view(current_property):
+    """Return (table, csv_bytes, summary) for the current property's records.
+
+    Memoized in session_state on (property, revision), where the revision changes with every
+    edit or reload, so the helpers above only run when the records change. Only the current
+    view is kept, so memory doesn't grow with the number of sessions or edits. All three are
+    None when there are no records.
+    """
+    key = (current_property, st.session_state.revision)
+    if st.session_state.get("ledger_view_key") != key:
+        df = expenses_frame(st.session_state.properties.get(current_property, []))
+        if df.empty:
+            view = (None, None, None)
+        else:
+            view = (expense_table(df), export_csv(df), summarize_expenses(df))
+        st.session_state.ledger_view = view
+        st.session_state.ledger_view_key = key
+    return st.session_state.ledger_view
+
+# 当天日期：每次运行只计算一次，供日期默认值和导出文件名使用
+today = datetime.now().date()
+today_str = today.isoformat().replace("-", "")
+
 # 应用标题
 st.title("🏠 房产记账工具")
 st.markdown("---")
@@ -140,32 +529,174 @@ if 'username' not in st.session_state:
     st.session_state.username = None
     st.session_state.properties = {}
     st.session_state.current_property = "默认房产"
+    st.session_state.dirty = False
+    st.session_state.pending_events = []
+    st.session_state.log_seq = 0
+    st.session_state.dirty_properties = set()
+    st.session_state.editor_version = 0
+    st.session_state.prop_index = {}
+    st.session_state.revision = 0
+
+# 以下交互使用回调：回调在脚本重跑之前修改 session_state，本次运行即可显示新状态，无需再调用 st.rerun()
+def login():
+    username = st.session_state.login_username
+    if not username:
+        return
+    if not valid_username(username):
+        # 用户名会作为数据目录名，不能包含路径分隔符或 ".."
+        st.error("用户名不能包含 / \\ 或 ..")
+        return
+    st.session_state.username = username
+    # 初始化用户数据
+    load_user_data()
+    reindex_properties()
+    # 设置当前房产为第一个房产
+    if st.session_state.properties:
+        st.session_state.current_property = next(iter(st.session_state.properties))
+
+
+def logout():
+    # 退出前提交尚未保存的修改
+    flush_user_data()
+    st.session_state.username = None
+    st.session_state.properties = {}
+    st.session_state.prop_index = {}
+    st.session_state.current_property = "默认房产"
+    st.session_state.pop("last_saved_hash", None)
+
 
 if st.session_state.username is None:
     st.subheader("用户登录")
     
     with st.form("login_form"):
-        username = st.text_input("用户名")
-        login_button = st.form_submit_button("登录")
-        
-        if login_button and username:
-            st.session_state.username = username
-            # 初始化用户数据
-            load_user_data()
-            # 设置当前房产为第一个房产
-            if st.session_state.properties:
-                st.session_state.current_property = list(st.session_state.properties.keys())[0]
-            st.rerun()
+        st.text_input("用户名", key="login_username")
+        st.form_submit_button("登录", on_click=login)
 else:
     st.sidebar.write(f"欢迎, {st.session_state.username}!")
-    if st.sidebar.button("退出登录"):
-        st.session_state.username = None
-        st.session_state.properties = {}
-        st.session_state.current_property = "默认房产"
-        st.rerun()
+    st.sidebar.button("退出登录", on_click=logout)
+
+def delete_expenses(property_name, editor_key):
+    """data_editor 回调：删除表格中删除的行（新增的空行忽略）。"""
+    expenses = st.session_state.properties.get(property_name, [])
+    # 从后往前删除以保持索引有效
+    for i in sorted(st.session_state[editor_key]["deleted_rows"], reverse=True):
+        record = expenses.pop(i)
+        mark_dirty({  # 标记数据待保存；附带被删除的记录，以便其他会话并发修改后重新定位
+            "op": "delete",
+            "property": property_name,
+            "index": i,
+            "record": record
+        })
+    # 更换表格key以清除已处理的删除状态
+    st.session_state.editor_version += 1
+
+
+# 费用明细与统计信息：作为一个 fragment 渲染，表格中的删除、下载等交互只重跑这一片段而不是整个脚本
+@st.fragment
+def render_ledger():
+    # 片段单独重跑时不会执行到脚本末尾，先在这里保存片段内（删除等回调）的修改；
+    # 保存时若合并了其他会话写入的数据，接下来的视图就已经是合并后的结果
+    flush_user_data()
+    current_property = st.session_state.current_property
+    # 列式视图、表格、CSV和统计只在记录变化时重新计算
+    table, csv_bytes, summary = ledger_view(current_property)
+    col1, col2 = st.columns([3, 1])
+
+    with col1:
+        render_details(current_property, table, csv_bytes)
+
+    with col2:
+        render_stats(summary)
+
+
+def render_details(current_property, table, csv_bytes):
+    st.subheader(f"费用明细 - {current_property}")
+
+    if table is not None:
+        # 显示费用记录表格：单个表格组件代替逐行渲染，选中行后按删除键即可删除记录
+        editor_key = f"expense_editor_{current_property}_{st.session_state.editor_version}"
+        st.data_editor(
+            table,
+            num_rows="dynamic",
+            disabled=EXPENSE_FIELDS,
+            hide_index=True,
+            column_config={"金额": st.column_config.NumberColumn(format="¥%.2f")},
+            key=editor_key,
+            on_change=delete_expenses,
+            args=(current_property, editor_key)
+        )
+
+        # 提供下载功能
+        st.download_button(
+            label="📥 下载CSV文件",
+            data=csv_bytes,
+            file_name=f'房产费用明细_{current_property}_{today_str}.csv',
+            mime='text/csv'
+        )
+    else:
+        st.info("暂无费用记录，请在左侧添加记录。")
+
+
+def render_stats(summary):
+    st.subheader("统计信息")
+
+    if summary is not None:
+        # 总费用及按类型汇总
+        total_amount, type_summary, hidden_types = summary
+        st.metric("总费用", f"¥{total_amount:,.2f}")
+
+        # 按费用类型分组统计（金额最高的前 SUMMARY_TOP_K 类，降序排列）
+        st.write("**按类型统计:**")
+        for expense_type, amount in type_summary.items():
+            st.write(f"{expense_type}: ¥{amount:,.2f}")
+        if hidden_types:
+            st.caption(f"另有 {hidden_types} 种费用类型未列出")
+
+        # 费用分布：单个横向条形图代替逐类型的进度条和文字
+        st.write("**费用分布:**")
+        if total_amount > 0:
+            distribution = pd.Series(type_summary, name="占比(%)") / total_amount * 100
+            st.bar_chart(distribution, horizontal=True, y_label="", x_label="占比(%)")
+    else:
+        st.info("暂无统计数据")
+
+
+def reindex_properties():
+    """Rebuild the property name → position map the selector uses; call after the property list changes."""
+    st.session_state.prop_index = {name: i for i, name in enumerate(st.session_state.properties)}
+
+
+def select_property():
+    st.session_state.current_property = st.session_state.property_selector
+
+
+def add_property():
+    new_property_name = st.session_state.new_property_name
+    if not new_property_name:
+        return
+    if new_property_name not in st.session_state.properties:
+        st.session_state.properties[new_property_name] = []
+        reindex_properties()
+        mark_dirty({"op": "add_property", "property": new_property_name})
+        st.sidebar.success(f"已添加房产: {new_property_name}")
+    else:
+        st.sidebar.warning("房产名称已存在")
+
+
+def delete_current_property():
+    deleted_property = st.session_state.current_property
+    del st.session_state.properties[deleted_property]
+    reindex_properties()
+    # 设置当前房产为第一个房产
+    st.session_state.current_property = next(iter(st.session_state.properties))
+    st.session_state.property_selector = st.session_state.current_property
+    mark_dirty({"op": "delete_property", "property": deleted_property})
+    st.session_state[f"confirm_delete_{deleted_property}"] = False
+
+
+def cancel_delete_property():
+    st.session_state[f"confirm_delete_{st.session_state.current_property}"] = False
 
-# 定义预设费用类型
-PRESET_EXPENSE_TYPES = ["契税", "土地出让金", "中介费", "装修费"]
 
 # 主要应用逻辑
 if st.session_state.username:
@@ -173,41 +704,29 @@ if st.session_state.username:
     st.sidebar.subheader("房产管理")
     
     # 选择当前房产
-    property_names = list(st.session_state.properties.keys())
-    if property_names:
+    prop_index = st.session_state.prop_index
+    if prop_index:
         # 确保当前选中的房产在列表中，如果不在则设置为第一个房产
-        if st.session_state.current_property not in property_names:
-            st.session_state.current_property = property_names[0]
+        if st.session_state.current_property not in prop_index:
+            st.session_state.current_property = next(iter(prop_index))
         
-        # 使用key参数确保selectbox状态的正确管理
-        selected_property = st.sidebar.selectbox(
+        # 使用key参数确保selectbox状态的正确管理；只有选择发生变化时才回调更新current_property
+        st.sidebar.selectbox(
             "选择房产", 
-            property_names, 
-            index=property_names.index(st.session_state.current_property),
-            key="property_selector"
+            list(prop_index), 
+            index=prop_index[st.session_state.current_property],
+            key="property_selector",
+            on_change=select_property
         )
-        # 只有当选择的房产发生变化时才更新current_property
-        if selected_property != st.session_state.current_property:
-            st.session_state.current_property = selected_property
-            # 强制重新运行以确保UI更新
-            st.rerun()
     else:
         st.session_state.current_property = "默认房产"
         st.session_state.properties[st.session_state.current_property] = []
+        reindex_properties()
     
     # 添加新房产
     with st.sidebar.form("add_property_form"):
-        new_property_name = st.text_input("新房产名称")
-        add_property_button = st.form_submit_button("添加房产")
-        
-        if add_property_button and new_property_name:
-            if new_property_name not in st.session_state.properties:
-                st.session_state.properties[new_property_name] = []
-                save_user_data()
-                st.success(f"已添加房产: {new_property_name}")
-                st.rerun()
-            else:
-                st.warning("房产名称已存在")
+        st.text_input("新房产名称", key="new_property_name")
+        st.form_submit_button("添加房产", on_click=add_property)
     
     # 删除当前房产
     if len(st.session_state.properties) > 1:
@@ -218,19 +737,8 @@ if st.session_state.username:
         if st.session_state.get(f"confirm_delete_{st.session_state.current_property}", False):
             st.sidebar.warning(f"确定要删除房产 '{st.session_state.current_property}' 吗？此操作无法撤销。")
             col1, col2 = st.sidebar.columns(2)
-            if col1.button("确认删除"):
-                del st.session_state.properties[st.session_state.current_property]
-                # 设置当前房产为第一个房产
-                st.session_state.current_property = list(st.session_state.properties.keys())[0]
-                save_user_data()
-                st.session_state[f"confirm_delete_{st.session_state.current_property}"] = False
-                st.rerun()
-            if col2.button("取消"):
-                st.session_state[f"confirm_delete_{st.session_state.current_property}"] = False
-                st.rerun()
-    
-    # 获取当前房产的费用记录
-    current_expenses = st.session_state.properties.get(st.session_state.current_property, [])
+            col1.button("确认删除", on_click=delete_current_property)
+            col2.button("取消", on_click=cancel_delete_property)
     
     # 侧边栏输入表单
     with st.sidebar:
@@ -239,7 +747,7 @@ if st.session_state.username:
         # 费用类型选择（独立于表单）。不使用 on_change 回调以避免在表单上下文中触发 StreamlitAPIException。
         st.selectbox(
             "费用类型",
-            PRESET_EXPENSE_TYPES + ["其他"],
+            EXPENSE_TYPE_CHOICES,
             key="expense_type",
             help="选择费用类型，选择‘其他’可自定义名称"
         )
@@ -250,7 +758,7 @@ if st.session_state.username:
 
         # 表单（只包含不需要回调的控件）
         with st.form(key="expense_form"):
-            date = st.date_input("日期", value=datetime.now().date())
+            date = st.date_input("日期", value=today)
             amount = st.number_input("金额", min_value=0.0, step=100.0, format="%.2f")
             description = st.text_area("描述（可选）")
 
@@ -266,7 +774,7 @@ if st.session_state.username:
                             chosen_type = custom
 
                     expense_record = {
-                        "日期": date.strftime("%Y-%m-%d"),
+                        "日期": date.isoformat(),
                         "费用类型": chosen_type,
                         "金额": amount,
                         "描述": description
@@ -275,101 +783,26 @@ if st.session_state.username:
                     if st.session_state.current_property not in st.session_state.properties:
                         st.session_state.properties[st.session_state.current_property] = []
                     st.session_state.properties[st.session_state.current_property].append(expense_record)
-                    save_user_data()  # 保存数据
+                    mark_dirty({  # 标记数据待保存
+                        "op": "add",
+                        "property": st.session_state.current_property,
+                        "record": expense_record
+                    })
                     st.success(f"已添加 {chosen_type} 记录！")
                 else:
                     st.error("金额必须大于0")
 
     # 主内容区域
-    col1, col2 = st.columns([3, 1])
-
-    with col1:
-        st.subheader(f"费用明细 - {st.session_state.current_property}")
-        
-        if current_expenses:
-            # 显示费用记录表格
-            # 创建表头
-            header_cols = st.columns([2, 2, 2, 3, 1])
-            header_cols[0].write("**日期**")
-            header_cols[1].write("**费用类型**")
-            header_cols[2].write("**金额**")
-            header_cols[3].write("**描述**")
-            header_cols[4].write("**操作**")
-            
-            # 显示每条记录
-            for i, expense in enumerate(current_expenses):
-                # 使用container来更好地组织每行记录
-                with st.container():
-                    record_cols = st.columns([2, 2, 2, 3, 1])
-                    record_cols[0].write(expense["日期"])
-                    record_cols[1].write(expense["费用类型"])
-                    record_cols[2].write(f"¥{expense['金额']:,.2f}")
-                    record_cols[3].write(expense["描述"] if expense["描述"] else "-")
-                    
-                    # 添加删除按钮
-                    if record_cols[4].button("🗑️", key=f"delete_{i}"):
-                        # 删除指定索引的费用记录
-                        st.session_state.properties[st.session_state.current_property].pop(i)
-                        save_user_data()  # 保存数据
-                        st.rerun()
-            
-            # 提供下载功能
-            def convert_to_csv():
-                output = io.StringIO()
-                writer = csv.writer(output)
-                writer.writerow(["日期", "费用类型", "金额", "描述"])
-                for expense in current_expenses:
-                    writer.writerow([
-                        expense["日期"],
-                        expense["费用类型"],
-                        expense["金额"],
-                        expense["描述"]
-                    ])
-                return output.getvalue().encode('utf-8')
-            
-            st.download_button(
-                label="📥 下载CSV文件",
-                data=convert_to_csv(),
-                file_name=f'房产费用明细_{st.session_state.current_property}_{datetime.now().strftime("%Y%m%d")}.csv',
-                mime='text/csv'
-            )
-        else:
-            st.info("暂无费用记录，请在左侧添加记录。")
-
-    with col2:
-        st.subheader("统计信息")
-        
-        if current_expenses:
-            # 计算总费用
-            total_amount = sum(expense["金额"] for expense in current_expenses)
-            st.metric("总费用", f"¥{total_amount:,.2f}")
-            
-            # 按费用类型分组统计
-            st.write("**按类型统计:**")
-            type_summary = defaultdict(float)
-            for expense in current_expenses:
-                type_summary[expense["费用类型"]] += expense["金额"]
-            
-            # 转换为排序后的列表
-            sorted_summary = sorted(type_summary.items(), key=lambda x: x[1], reverse=True)
-            
-            for expense_type, amount in sorted_summary:
-                st.write(f"{expense_type}: ¥{amount:,.2f}")
-                
-            # 简单文本形式的费用分布
-            st.write("**费用分布:**")
-            for expense_type, amount in sorted_summary:
-                percentage = (amount / total_amount) * 100 if total_amount > 0 else 0
-                st.progress(percentage / 100)
-                st.write(f"{expense_type}: {percentage:.1f}%")
-        else:
-            st.info("暂无统计数据")
+    render_ledger()
 
     # 清空当前房产的所有记录按钮
+    # current_expenses = st.session_state.properties.get(st.session_state.current_property, [])
     # if current_expenses:
     #     if st.button("🗑️ 清空当前房产的所有记录"):
     #         st.session_state.properties[st.session_state.current_property] = []
-    #         save_user_data()  # 保存数据
-    #         st.rerun()
+    #         mark_dirty()  # 标记数据待保存
 else:
-    st.info("请输入用户名登录以使用应用。")
\ No newline at end of file
+    st.info("请输入用户名登录以使用应用。")
+
+# 每次运行结束时统一保存，合并本次运行中的多次修改
+flush_user_data()
@@ -0,0 +1,150 @@
+"""Tests for the event log in ledger_core: rebasing, replay and the tail scan."""
+from ledger_core import LOG_TAIL_BYTES, apply_event, encode_event, last_seq, rebase_event, replay_log
+
+
+def record(date, kind, amount, note=""):
+    return {"日期": date, "费用类型": kind, "金额": amount, "描述": note}
+
+
+A = record("2024-01-01", "物业费", 100.0)
+B = record("2024-01-02", "水费", 20.5)
+C = record("2024-01-03", "电费", 30.0)
+
+
+def write_log(path, events, start=1):
+    with open(path, "wb") as f:
+        for seq, event in enumerate(events, start):
+            f.write(encode_event(seq, event))
+
+
+# --- rebase_event / apply_event ---
+def test_rebase_repoints_stale_delete():
+    # this session deleted B at index 1; another session meanwhile deleted A, so B is now at 0
+    properties = {"p": [B, C]}
+    event = rebase_event(properties, {"op": "delete", "property": "p", "index": 1, "record": B})
+    assert event["index"] == 0
+    apply_event(properties, event)
+    assert properties == {"p": [C]}
+
+
+def test_rebase_drops_delete_of_removed_record():
+    properties = {"p": [A, C]}
+    assert rebase_event(properties, {"op": "delete", "property": "p", "index": 1, "record": B}) is None
+
+
+def test_rebase_keeps_matching_delete_among_duplicates():
+    # identical records: the one at the logged index is removed, not the first match
+    properties = {"p": [A, A, A]}
+    event = {"op": "delete", "property": "p", "index": 2, "record": A}
+    assert rebase_event(properties, event) == event
+    apply_event(properties, event)
+    assert properties == {"p": [A, A]}
+
+
+def test_rebase_delete_of_duplicate_after_shift():
+    properties = {"p": [A, B, A]}
+    event = rebase_event(properties, {"op": "delete", "property": "p", "index": 5, "record": A})
+    assert event["index"] == 0
+    apply_event(properties, event)
+    assert properties == {"p": [B, A]}
+
+
+def test_rebase_drops_delete_from_missing_property():
+    assert rebase_event({}, {"op": "delete", "property": "p", "index": 0, "record": A}) is None
+
+
+def test_rebase_keeps_add_to_property_missing_on_disk():
+    # 默认房产 only exists in memory until its first save
+    properties = {}
+    event = {"op": "add", "property": "默认房产", "record": A}
+    assert rebase_event(properties, event) == event
+    apply_event(properties, event)
+    assert properties == {"默认房产": [A]}
+
+
+def test_rebase_drops_duplicate_add_property():
+    assert rebase_event({"p": []}, {"op": "add_property", "property": "p"}) is None
+    event = {"op": "add_property", "property": "q"}
+    assert rebase_event({"p": []}, event) == event
+
+
+def test_apply_skips_out_of_range_delete():
+    properties = {"p": [A]}
+    apply_event(properties, {"op": "delete", "property": "p", "index": 3})
+    apply_event(properties, {"op": "delete", "property": "missing", "index": 0})
+    assert properties == {"p": [A]}
+
+
+# --- replay_log ---
+def test_replay_roundtrips_short_keys(tmp_path):
+    log = tmp_path / "events.ndjson"
+    write_log(log, [{"op": "add", "property": "p", "record": A}, {"op": "add", "property": "q", "record": B}])
+    properties, touched = {}, set()
+    assert replay_log(str(log), properties, 0, touched) == 2
+    assert properties == {"p": [A], "q": [B]}
+    assert touched == {"p", "q"}
+
+
+def test_replay_skips_events_in_snapshot(tmp_path):
+    log = tmp_path / "events.ndjson"
+    write_log(log, [{"op": "add", "property": "p", "record": A}, {"op": "add", "property": "p", "record": B}])
+    properties, touched = {"p": [A]}, set()
+    assert replay_log(str(log), properties, 1, touched) == 2
+    assert properties == {"p": [A, B]}
+
+
+def test_replay_stops_at_torn_last_line(tmp_path):
+    log = tmp_path / "events.ndjson"
+    write_log(log, [{"op": "add", "property": "p", "record": A}])
+    with open(log, "ab") as f:
+        f.write(encode_event(2, {"op": "add", "property": "p", "record": B})[:-10])
+    properties = {}
+    assert replay_log(str(log), properties, 0, set()) == 1
+    assert properties == {"p": [A]}
+
+
+def test_replay_tolerates_seq_gaps(tmp_path):
+    log = tmp_path / "events.ndjson"
+    with open(log, "wb") as f:
+        f.write(encode_event(3, {"op": "add", "property": "p", "record": A}))
+        f.write(encode_event(7, {"op": "add", "property": "p", "record": B}))
+        f.write(encode_event(8, {"op": "delete", "property": "p", "index": 0, "record": A}))
+    properties = {}
+    assert replay_log(str(log), properties, 2, set()) == 8
+    assert properties == {"p": [B]}
+
+
+def test_replay_missing_log(tmp_path):
+    properties = {"p": [A]}
+    assert replay_log(str(tmp_path / "none.ndjson"), properties, 4, set()) == 4
+    assert properties == {"p": [A]}
+
+
+# --- last_seq ---
+def test_last_seq_missing_or_empty_log(tmp_path):
+    assert last_seq(str(tmp_path / "none.ndjson"), 5) == 5
+    log = tmp_path / "events.ndjson"
+    log.write_bytes(b"")
+    assert last_seq(str(log), 5) == 5
+
+
+def test_last_seq_skips_torn_last_line(tmp_path):
+    log = tmp_path / "events.ndjson"
+    write_log(log, [{"op": "add", "property": "p", "record": A}] * 3)
+    with open(log, "ab") as f:
+        f.write(b'{"seq":4,"op":"ad')
+    assert last_seq(str(log), 0) == 3
+
+
+def test_last_seq_keeps_newer_snapshot_seq(tmp_path):
+    log = tmp_path / "events.ndjson"
+    write_log(log, [{"op": "add", "property": "p", "record": A}])
+    assert last_seq(str(log), 9) == 9
+
+
+def test_last_seq_reads_only_the_tail(tmp_path):
+    log = tmp_path / "events.ndjson"
+    events = [{"op": "add", "property": "p", "record": record("2024-01-01", "物业费", i, "x" * 100)} for i in range(2000)]
+    write_log(log, events, start=10)
+    assert log.stat().st_size > LOG_TAIL_BYTES
+    assert last_seq(str(log), 0) == 2009